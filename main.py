@@ -1,15 +1,24 @@
+import ast
+import asyncio
+import logging
+import operator
 import os
+from functools import lru_cache
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any, Literal
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
+import orjson
 from pydantic import BaseModel, Field
 
-from database import db, create_document
+from database import db, redis, create_document
+from schemas import SCHEMA_DUMP
 
-app = FastAPI(title="Telegram 2.0 API")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Telegram 2.0 API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,6 +28,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the indexes backing the list queries (idempotent)."""
+    if db is None:
+        return
+    try:
+        await asyncio.gather(
+            db["chat"].create_index([("participants", 1), ("last_message_at", -1)]),
+            db["message"].create_index([("chat_id", 1), ("created_at", -1)]),
+            db["channel"].create_index([("tags", 1), ("trending_score", -1)]),
+            db["post"].create_index([("channel_id", 1), ("created_at", -1)]),
+            db["story"].create_index([("author_id", 1), ("created_at", -1)]),
+            db["automationflow"].create_index([("owner_id", 1), ("created_at", -1)]),
+        )
+    except Exception:
+        logger.exception("Index creation failed")
+
 # ------------------------
 # Helpers & Auth (very simple mock token)
 # ------------------------
@@ -27,15 +53,190 @@ def now_utc():
     return datetime.now(timezone.utc)
 
 
+async def request_now() -> datetime:
+    """Dependency giving one timestamp per request (async, so no threadpool hop)."""
+    return now_utc()
+
+
+_collections: Dict[str, Any] = {}
+
+
 def collection(name: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    return db[name]
+    coll = _collections.get(name)
+    if coll is None:
+        coll = _collections[name] = db[name]
+    return coll
 
 
-def require_user(user_id: Optional[str]):
+def require_user(user_id: Optional[str] = Header(None, alias="X-User-Id")) -> str:
+    """Dependency resolving the caller's id from the X-User-Id header."""
     if not user_id:
         raise HTTPException(status_code=401, detail="Missing X-User-Id header")
+    return user_id
+
+
+_background_tasks = set()
+
+
+def run_in_background(coro):
+    """Fire and forget a coroutine, holding a reference until it completes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+STREAM_BATCH_SIZE = 100
+
+
+async def stream_documents(cursor) -> Response:
+    """Stream a Mongo cursor as a JSON array, encoding one batch at a time."""
+    cursor.batch_size(STREAM_BATCH_SIZE)
+    # Fetch the first batch before any headers go out, so query and
+    # connection errors still surface as a 500 rather than a truncated 200
+    first = await cursor.to_list(length=STREAM_BATCH_SIZE)
+    head = b"[" + b",".join(orjson.dumps(doc) for doc in first)
+    if len(first) < STREAM_BATCH_SIZE:
+        return Response(content=head + b"]", media_type="application/json")
+
+    async def body():
+        yield head
+        chunk = []
+        async for doc in cursor:
+            chunk.append(b",")
+            chunk.append(orjson.dumps(doc))
+            if len(chunk) >= 2 * STREAM_BATCH_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+        chunk.append(b"]")
+        yield b"".join(chunk)
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+# Flow conditions are parsed once and turned into nested closures over ctx.
+# Only comparisons, boolean logic, numeric arithmetic, literals and ctx[...]
+# lookups are supported; there are no calls, attributes or builtins, and
+# arithmetic refuses non-numbers so an expression can't build huge objects.
+_BIN_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.Mod: operator.mod,
+}
+_UNARY_OPS = {ast.Not: operator.not_, ast.USub: operator.neg, ast.UAdd: operator.pos}
+_CMP_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Is: operator.is_, ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+_CONSTANT_TYPES = (str, int, float, bool, type(None))
+_MAX_INT_BITS = 64
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("Arithmetic in conditions only applies to numbers")
+    if isinstance(value, int) and value.bit_length() > _MAX_INT_BITS:
+        raise ValueError("Integer too large in condition")
+    return value
+
+
+def _build_constant(node):
+    value = node.value
+    if not isinstance(value, _CONSTANT_TYPES):
+        raise ValueError(f"Unsupported constant in condition: {type(value).__name__}")
+    return lambda ctx: value
+
+
+def _build_name(node):
+    if node.id != "ctx":
+        raise ValueError(f"Unknown name in condition: {node.id}")
+    return lambda ctx: ctx
+
+
+def _build_subscript(node):
+    value, key = _build(node.value), _build(node.slice)
+    return lambda ctx: value(ctx)[key(ctx)]
+
+
+def _build_boolop(node):
+    values = [_build(v) for v in node.values]
+    stop_on = False if isinstance(node.op, ast.And) else True
+
+    def evaluate(ctx):
+        result = None
+        for v in values:
+            result = v(ctx)
+            if bool(result) is stop_on:
+                break
+        return result
+    return evaluate
+
+
+def _build_unaryop(node):
+    op, operand = _UNARY_OPS[type(node.op)], _build(node.operand)
+    if isinstance(node.op, ast.Not):
+        return lambda ctx: op(operand(ctx))
+    return lambda ctx: op(_number(operand(ctx)))
+
+
+def _build_binop(node):
+    op = _BIN_OPS[type(node.op)]
+    left, right = _build(node.left), _build(node.right)
+    return lambda ctx: op(_number(left(ctx)), _number(right(ctx)))
+
+
+def _build_compare(node):
+    left = _build(node.left)
+    pairs = [(_CMP_OPS[type(op)], _build(c)) for op, c in zip(node.ops, node.comparators)]
+
+    def evaluate(ctx):
+        a = left(ctx)
+        for op, comparator in pairs:
+            b = comparator(ctx)
+            if not op(a, b):
+                return False
+            a = b
+        return True
+    return evaluate
+
+
+def _build_sequence(kind):
+    def build(node):
+        elts = [_build(e) for e in node.elts]
+        return lambda ctx: kind(e(ctx) for e in elts)
+    return build
+
+
+_BUILDERS = {
+    ast.Constant: _build_constant,
+    ast.Name: _build_name,
+    ast.Subscript: _build_subscript,
+    ast.BoolOp: _build_boolop,
+    ast.UnaryOp: _build_unaryop,
+    ast.BinOp: _build_binop,
+    ast.Compare: _build_compare,
+    ast.List: _build_sequence(list),
+    ast.Tuple: _build_sequence(tuple),
+    ast.Set: _build_sequence(set),
+}
+
+
+def _build(node):
+    builder = _BUILDERS.get(type(node))
+    if builder is None:
+        raise ValueError(f"Unsupported syntax in condition: {type(node).__name__}")
+    try:
+        return builder(node)
+    except KeyError:
+        # operator outside the tables above, e.g. ** or //
+        raise ValueError("Unsupported operator in condition")
+
+
+@lru_cache(maxsize=1024)
+def compile_expr(expr: str):
+    """Parse a flow condition once into a callable taking ctx."""
+    return _build(ast.parse(expr, "<flow>", "eval").body)
 
 
 # ------------------------
@@ -87,9 +288,14 @@ class AutomationFlowIn(BaseModel):
     nodes: List[Dict[str, Any]]
     edges: List[Dict[str, Any]]
 
+MAX_FLOW_NODES = 10_000
+MAX_FLOW_EDGES = 50_000
+# total node visits across all start nodes in one execute call
+MAX_FLOW_STEPS = 50_000
+
 class AutomationExecuteIn(BaseModel):
-    nodes: List[Dict[str, Any]]
-    edges: List[Dict[str, Any]]
+    nodes: List[Dict[str, Any]] = Field(..., max_length=MAX_FLOW_NODES)
+    edges: List[Dict[str, Any]] = Field(..., max_length=MAX_FLOW_EDGES)
     payload: Dict[str, Any] = {}
 
 class StoryIn(BaseModel):
@@ -105,7 +311,7 @@ def read_root():
     return {"message": "Telegram 2.0 Backend Running"}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -118,7 +324,7 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Connected"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()
+            response["collections"] = await db.list_collection_names()
     except Exception as e:
         response["database"] = f"⚠️ Error: {str(e)[:80]}"
     return response
@@ -127,74 +333,85 @@ def test_database():
 # Schema endpoint for tooling
 # ------------------------
 
+SCHEMA_BYTES = orjson.dumps({"models": SCHEMA_DUMP})
+
 @app.get("/schema")
 def get_schema():
-    try:
-        import schemas as s
-        models = [
-            {"name": name, "fields": list(getattr(s, name).model_fields.keys())}
-            for name in dir(s)
-            if hasattr(getattr(s, name), "model_fields")
-        ]
-        return {"models": models}
-    except Exception as e:
-        return {"error": str(e)}
+    return Response(content=SCHEMA_BYTES, media_type="application/json")
 
 # ------------------------
 # Auth: OTP mock flow
 # ------------------------
 
+OTP_TTL = 300  # seconds
+
 @app.post("/api/auth/request-otp")
-def request_otp(payload: OTPRequest):
+async def request_otp(payload: OTPRequest, now: datetime = Depends(request_now)):
     code = "123456"  # Mocked code
-    sessions = collection("session")
-    sessions.insert_one({
+    session = {
         "phone": payload.phone,
         "otp_code": code,
         "verified": False,
-        "created_at": now_utc(),
-        "updated_at": now_utc()
-    })
+        "created_at": now,
+        "updated_at": now
+    }
+    if redis is not None:
+        await redis.set(f"otp:{payload.phone}", code, ex=OTP_TTL)
+        # the session collection is only an audit trail here
+        run_in_background(collection("session").insert_one(session))
+    else:
+        await collection("session").insert_one(session)
     return {"ok": True, "code": code}
 
 @app.post("/api/auth/verify-otp")
-def verify_otp(payload: OTPVerify):
-    sess = collection("session").find_one({"phone": payload.phone}, sort=[("created_at", -1)])
-    if not sess or sess.get("otp_code") != payload.code:
-        raise HTTPException(status_code=400, detail="Invalid code")
+async def verify_otp(payload: OTPVerify, now: datetime = Depends(request_now)):
+    if redis is not None:
+        # GETDEL is atomic, so two concurrent verifies can't both accept the
+        # same code; a wrong guess also burns it and a new code must be requested
+        stored = await redis.getdel(f"otp:{payload.phone}")
+        if stored is None or stored.decode() != payload.code:
+            raise HTTPException(status_code=400, detail="Invalid code")
+    else:
+        sess = await collection("session").find_one({"phone": payload.phone}, sort=[("created_at", -1)])
+        if not sess or sess.get("otp_code") != payload.code:
+            raise HTTPException(status_code=400, detail="Invalid code")
     # Find or create user
-    user = collection("user").find_one({"phone": payload.phone})
+    user = await collection("user").find_one({"phone": payload.phone})
     if not user:
-        uid = create_document("user", {"phone": payload.phone, "name": "", "privacy_mode": False,
-                                         "creator_mode": False, "notifications_enabled": True})
+        uid = await create_document("user", {"phone": payload.phone, "name": "", "privacy_mode": False,
+                                             "creator_mode": False, "notifications_enabled": True}, now=now)
         from bson import ObjectId
-        user = collection("user").find_one({"_id": ObjectId(uid)})
+        user = await collection("user").find_one({"_id": ObjectId(uid)})
     token = str(user["_id"]) if user else None
-    collection("session").update_many({"phone": payload.phone}, {"$set": {"verified": True, "updated_at": now_utc()}})
+    mark_verified = collection("session").update_many({"phone": payload.phone}, {"$set": {"verified": True, "updated_at": now}})
+    if redis is not None:
+        # Audit only. If this runs before request_otp's background insert has
+        # landed (a verify within milliseconds of the request), that audit row
+        # stays verified=False; the code check itself does not depend on it.
+        run_in_background(mark_verified)
+    else:
+        await mark_verified
     return {"ok": True, "user_id": token}
 
 @app.get("/api/users/me")
-async def get_me(request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
+async def get_me(user_id: str = Depends(require_user)):
     from bson import ObjectId
     try:
-        u = collection("user").find_one({"_id": ObjectId(user_id)})
+        u = await collection("user").find_one({"_id": ObjectId(user_id)})
     except Exception:
         u = None
     if not u:
         raise HTTPException(status_code=404, detail="User not found")
-    u["_id"] = str(u["_id"])
     return u
 
 @app.put("/api/users/me")
-async def update_me(request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    body = await request.json()
+async def update_me(payload: ProfileUpdate, user_id: str = Depends(require_user),
+                    now: datetime = Depends(request_now)):
+    # Only persist the fields the client actually sent
+    body = payload.model_dump(exclude_unset=True)
     from bson import ObjectId
     try:
-        collection("user").update_one({"_id": ObjectId(user_id)}, {"$set": {**body, "updated_at": now_utc()}})
+        await collection("user").update_one({"_id": ObjectId(user_id)}, {"$set": {**body, "updated_at": now}})
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid user id")
     return {"ok": True}
@@ -204,53 +421,43 @@ async def update_me(request: Request):
 # ------------------------
 
 @app.get("/api/chats")
-def list_chats(request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    chats = list(collection("chat").find({"participants": user_id}).sort("last_message_at", -1))
-    for c in chats:
-        c["_id"] = str(c["_id"])
-    return chats
+async def list_chats(user_id: str = Depends(require_user)):
+    return await stream_documents(collection("chat").find({"participants": user_id}).sort("last_message_at", -1))
 
 @app.post("/api/chats")
-def create_chat(payload: ChatCreate, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    participants = list(set(payload.participants + [user_id]))
-    cid = create_document("chat", {
+async def create_chat(payload: ChatCreate, user_id: str = Depends(require_user),
+                      now: datetime = Depends(request_now)):
+    # dedupe keeping first occurrences in client order; the creator is appended only if absent
+    participants = list(dict.fromkeys(payload.participants + [user_id]))
+    cid = await create_document("chat", {
         "type": payload.type,
         "title": payload.title,
         "participants": participants,
-        "last_message_at": now_utc(),
+        "last_message_at": now,
         "pinned": False
-    })
+    }, now=now)
     return {"ok": True, "chat_id": cid}
 
 @app.get("/api/chats/{chat_id}/messages")
-def get_messages(chat_id: str, limit: int = 50):
-    msgs = list(collection("message").find({"chat_id": chat_id}).sort("created_at", -1).limit(limit))
-    for m in msgs:
-        m["_id"] = str(m["_id"])
-    return list(reversed(msgs))
+async def get_messages(chat_id: str, limit: int = 50):
+    msgs = await collection("message").find({"chat_id": chat_id}).sort("created_at", -1).limit(limit).to_list(length=None)
+    msgs.reverse()
+    return msgs
 
 @app.get("/api/chats/{chat_id}/threads/{root_id}")
-def get_thread(chat_id: str, root_id: str, limit: int = 50):
+async def get_thread(chat_id: str, root_id: str, limit: int = 50):
     from bson import ObjectId
     # include root message and all with thread_root_id == root_id
     q = {"chat_id": chat_id, "$or": [{"_id": ObjectId(root_id)}, {"thread_root_id": root_id}]}
-    msgs = list(collection("message").find(q).sort("created_at", 1).limit(limit))
-    for m in msgs:
-        m["_id"] = str(m["_id"])
-    return msgs
+    return await stream_documents(collection("message").find(q).sort("created_at", 1).limit(limit))
 
 @app.patch("/api/messages/{message_id}/reactions")
-async def patch_reaction(message_id: str, payload: Dict[str, Any], request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
+async def patch_reaction(message_id: str, payload: Dict[str, Any], user_id: str = Depends(require_user),
+                         now: datetime = Depends(request_now)):
     emoji = payload.get("emoji")
     action = payload.get("action", "add")
     from bson import ObjectId
-    msg = collection("message").find_one({"_id": ObjectId(message_id)})
+    msg = await collection("message").find_one({"_id": ObjectId(message_id)})
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
     reactions = msg.get("reactions", {})
@@ -260,30 +467,36 @@ async def patch_reaction(message_id: str, payload: Dict[str, Any], request: Requ
     else:
         users.discard(user_id)
     reactions[emoji] = list(users)
-    collection("message").update_one({"_id": ObjectId(message_id)}, {"$set": {"reactions": reactions, "updated_at": now_utc()}})
+    await collection("message").update_one({"_id": ObjectId(message_id)}, {"$set": {"reactions": reactions, "updated_at": now}})
     # broadcast reaction update
     await await_broadcast(msg.get("chat_id", ""), {"type": "reaction", "message_id": message_id, "emoji": emoji, "users": list(users)})
     return {"ok": True, "reactions": reactions}
 
 @app.post("/api/chats/{chat_id}/messages")
-async def send_message(chat_id: str, payload: MessageCreate, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    mid = create_document("message", {
+async def send_message(chat_id: str, payload: MessageCreate, user_id: str = Depends(require_user),
+                       now: datetime = Depends(request_now)):
+    from bson import ObjectId
+    # Allocate the id client-side so the insert and the chat bump go out together
+    message_oid = ObjectId()
+    mid = str(message_oid)
+
+    async def update_chat():
+        # update chat last_message_at if chat exists
+        try:
+            await collection("chat").update_one({"_id": ObjectId(chat_id)}, {"$set": {"last_message_at": now}})
+        except Exception:
+            pass
+
+    await asyncio.gather(create_document("message", {
+        "_id": message_oid,
         "chat_id": chat_id,
         "sender_id": user_id,
         "text": payload.text,
         "attachments": payload.attachments,
         "thread_root_id": payload.thread_root_id,
         "reactions": {},
-    })
-    # update chat last_message_at if chat exists
-    from bson import ObjectId
-    try:
-        collection("chat").update_one({"_id": ObjectId(chat_id)}, {"$set": {"last_message_at": now_utc()}})
-    except Exception:
-        pass
-    # Notify via websockets
+    }, now=now), update_chat())
+    # Notify via websockets once the message is stored
     await await_broadcast(chat_id, {
         "type": "message",
         "message_id": mid,
@@ -291,7 +504,7 @@ async def send_message(chat_id: str, payload: MessageCreate, request: Request):
         "sender_id": user_id,
         "attachments": payload.attachments,
         "thread_root_id": payload.thread_root_id,
-        "created_at": now_utc().isoformat()
+        "created_at": now.isoformat()
     })
     return {"ok": True, "message_id": mid}
 
@@ -299,26 +512,101 @@ async def send_message(chat_id: str, payload: MessageCreate, request: Request):
 # WebSocket manager per chat
 # ------------------------
 
+CHAT_CHANNEL_PREFIX = "chat:"
+
+SEND_QUEUE_SIZE = 256  # pending frames per socket before it is dropped as too slow
+
 class ConnectionManager:
     def __init__(self):
         self.active: Dict[str, List[WebSocket]] = {}
+        # each socket gets its own queue and writer task, so a slow client
+        # only ever delays itself
+        self.queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
 
     async def connect(self, chat_id: str, websocket: WebSocket):
         await websocket.accept()
         self.active.setdefault(chat_id, []).append(websocket)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.queues[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._write(chat_id, websocket, queue))
 
     def disconnect(self, chat_id: str, websocket: WebSocket):
         if chat_id in self.active and websocket in self.active[chat_id]:
             self.active[chat_id].remove(websocket)
+        self.queues.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
+    async def _write(self, chat_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                await websocket.send_text(await queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(chat_id, websocket)
 
     async def broadcast(self, chat_id: str, message: Dict[str, Any]):
+        data = orjson.dumps(message)
+        if redis is not None:
+            # Every worker's listener picks this up and delivers to its own sockets
+            try:
+                await redis.publish(f"{CHAT_CHANNEL_PREFIX}{chat_id}", data)
+            except Exception as e:
+                # best effort, like local sends: the write that triggered this already happened
+                logger.warning("Broadcast publish failed: %s", e)
+        else:
+            self.deliver(chat_id, data.decode())
+
+    def deliver(self, chat_id: str, data: str):
+        """Queue a frame for every local socket in the chat without waiting on any of them."""
         for ws in list(self.active.get(chat_id, [])):
             try:
-                await ws.send_json(message)
-            except Exception:
+                self.queues[ws].put_nowait(data)
+            except asyncio.QueueFull:
+                # the client is not keeping up; drop it instead of buffering without bound
                 self.disconnect(chat_id, ws)
+                run_in_background(self._close(ws))
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def listen(self):
+        """Relay messages published by any worker to the sockets connected here."""
+        while True:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(f"{CHAT_CHANNEL_PREFIX}*")
+                async for msg in pubsub.listen():
+                    chat_id = msg["channel"].decode()[len(CHAT_CHANNEL_PREFIX):]
+                    self.deliver(chat_id, msg["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broadcast listener error")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
 
 manager = ConnectionManager()
+_listener_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_broadcast_listener():
+    global _listener_task
+    if redis is not None:
+        _listener_task = asyncio.create_task(manager.listen())
+
+@app.on_event("shutdown")
+async def stop_broadcast_listener():
+    if _listener_task is not None:
+        _listener_task.cancel()
 
 async def await_broadcast(chat_id: str, message: Dict[str, Any]):
     if not chat_id:
@@ -333,25 +621,85 @@ async def chat_ws(websocket: WebSocket, chat_id: str):
             data = await websocket.receive_text()
             await manager.broadcast(chat_id, {"type": "ping", "echo": data})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(chat_id, websocket)
 
 # ------------------------
 # Channels & posts
 # ------------------------
 
+# Trending channels are mirrored into Redis sorted sets (one global, one per
+# tag) scored by trending_score, with each channel's JSON under channel:<id>.
+TRENDING_KEY = "channels:trending"
+TRENDING_READY_KEY = "channels:trending:ready"
+TRENDING_LOCK_KEY = "channels:trending:rebuild"
+TRENDING_LOCK_TTL = 300  # seconds
+TRENDING_LIMIT = 50
+
+def trending_key(tag: Optional[str]) -> str:
+    return f"{TRENDING_KEY}:tag:{tag}" if tag else TRENDING_KEY
+
+def index_channel(pipe, ch: Dict[str, Any]):
+    """Queue the write-through of one channel onto a Redis pipeline."""
+    cid = ch["_id"]
+    score = ch.get("trending_score", 0.0)
+    pipe.set(f"channel:{cid}", orjson.dumps(ch))
+    for key in [TRENDING_KEY] + [trending_key(t) for t in ch.get("tags", [])]:
+        pipe.zadd(key, {cid: score})
+
+@app.on_event("startup")
+async def rebuild_trending_index():
+    """Load every channel into the trending sets, then mark them complete."""
+    if redis is None or db is None:
+        return
+    try:
+        # one worker rebuilds; the rest skip, and so does a restart onto a complete index
+        if await redis.exists(TRENDING_READY_KEY):
+            return
+        if not await redis.set(TRENDING_LOCK_KEY, 1, nx=True, ex=TRENDING_LOCK_TTL):
+            return
+    except Exception:
+        logger.exception("Trending index rebuild failed")
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        async for ch in db["channel"].find({}).batch_size(STREAM_BATCH_SIZE):
+            index_channel(pipe, ch)
+            if len(pipe) >= 10 * STREAM_BATCH_SIZE:
+                await pipe.execute()
+        pipe.set(TRENDING_READY_KEY, 1)
+        await pipe.execute()
+    except Exception:
+        logger.exception("Trending index rebuild failed")
+    finally:
+        try:
+            await redis.delete(TRENDING_LOCK_KEY)
+        except Exception:
+            pass
+
 @app.get("/api/channels")
-def list_channels(tag: Optional[str] = None):
+async def list_channels(tag: Optional[str] = None):
+    if redis is not None:
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.exists(TRENDING_READY_KEY)
+            pipe.zrevrange(trending_key(tag), 0, TRENDING_LIMIT - 1)
+            ready, ids = await pipe.execute()
+            # until the index has been rebuilt (e.g. after a Redis restart) use Mongo
+            if ready:
+                blobs = await redis.mget([f"channel:{cid.decode()}" for cid in ids]) if ids else []
+                body = b"[" + b",".join(blob for blob in blobs if blob is not None) + b"]"
+                return Response(content=body, media_type="application/json")
+        except Exception as e:
+            logger.warning("Trending index read failed, using Mongo: %s", e)
+
     q = {"tags": tag} if tag else {}
-    chans = list(collection("channel").find(q).sort("trending_score", -1).limit(50))
-    for ch in chans:
-        ch["_id"] = str(ch["_id"])
-    return chans
+    return await collection("channel").find(q).sort("trending_score", -1).limit(TRENDING_LIMIT).to_list(length=None)
 
 @app.post("/api/channels")
-def create_channel(payload: ChannelCreate, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    cid = create_document("channel", {
+async def create_channel(payload: ChannelCreate, user_id: str = Depends(require_user)):
+    cid = await create_document("channel", {
         "title": payload.title,
         "description": payload.description,
         "owner_id": user_id,
@@ -359,29 +707,39 @@ def create_channel(payload: ChannelCreate, request: Request):
         "tags": payload.tags,
         "trending_score": 0.0,
     })
+    if redis is not None:
+        # read back so the cached JSON matches what Mongo returns
+        from bson import ObjectId
+        ch = await collection("channel").find_one({"_id": ObjectId(cid)})
+        try:
+            pipe = redis.pipeline(transaction=False)
+            index_channel(pipe, ch)
+            await pipe.execute()
+        except Exception:
+            # the channel is stored; make listings fall back to Mongo rather
+            # than serve an index that is missing it
+            logger.exception("Trending write-through failed")
+            try:
+                await redis.delete(TRENDING_READY_KEY)
+            except Exception:
+                pass
     return {"ok": True, "channel_id": cid}
 
 @app.get("/api/channels/{channel_id}")
-def get_channel(channel_id: str):
+async def get_channel(channel_id: str):
     from bson import ObjectId
-    ch = collection("channel").find_one({"_id": ObjectId(channel_id)})
+    ch = await collection("channel").find_one({"_id": ObjectId(channel_id)})
     if not ch:
         raise HTTPException(status_code=404, detail="Channel not found")
-    ch["_id"] = str(ch["_id"])
     return ch
 
 @app.get("/api/channels/{channel_id}/posts")
-def list_posts(channel_id: str):
-    posts = list(collection("post").find({"channel_id": channel_id}).sort("created_at", -1))
-    for p in posts:
-        p["_id"] = str(p["_id"])
-    return posts
+async def list_posts(channel_id: str):
+    return await stream_documents(collection("post").find({"channel_id": channel_id}).sort("created_at", -1))
 
 @app.post("/api/channels/{channel_id}/posts")
-def create_post(channel_id: str, payload: PostCreate, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    pid = create_document("post", {
+async def create_post(channel_id: str, payload: PostCreate, user_id: str = Depends(require_user)):
+    pid = await create_document("post", {
         "channel_id": channel_id,
         "author_id": user_id,
         "content_text": payload.content_text,
@@ -395,26 +753,16 @@ def create_post(channel_id: str, payload: PostCreate, request: Request):
 # ------------------------
 
 @app.get("/api/stories")
-async def list_my_stories(request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    docs = list(collection("story").find({"author_id": user_id}).sort("created_at", -1))
-    for d in docs:
-        d["_id"] = str(d["_id"])
-    return docs
+async def list_my_stories(user_id: str = Depends(require_user)):
+    return await stream_documents(collection("story").find({"author_id": user_id}).sort("created_at", -1))
 
 @app.get("/api/stories/{user_id}")
 async def list_user_stories(user_id: str):
-    docs = list(collection("story").find({"author_id": user_id}).sort("created_at", -1))
-    for d in docs:
-        d["_id"] = str(d["_id"])
-    return docs
+    return await stream_documents(collection("story").find({"author_id": user_id}).sort("created_at", -1))
 
 @app.post("/api/stories")
-async def create_story(payload: StoryIn, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    sid = create_document("story", {"author_id": user_id, "background": payload.background, "text": payload.text})
+async def create_story(payload: StoryIn, user_id: str = Depends(require_user)):
+    sid = await create_document("story", {"author_id": user_id, "background": payload.background, "text": payload.text})
     return {"ok": True, "story_id": sid}
 
 # ------------------------
@@ -422,9 +770,8 @@ async def create_story(payload: StoryIn, request: Request):
 # ------------------------
 
 @app.post("/api/analytics/events")
-def analytics_event(payload: AnalyticsEventIn, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    create_document("analyticsevent", {
+async def analytics_event(payload: AnalyticsEventIn, user_id: Optional[str] = Header(None, alias="X-User-Id")):
+    await create_document("analyticsevent", {
         "user_id": user_id or "anon",
         "event": payload.event,
         "meta": payload.meta,
@@ -436,19 +783,12 @@ def analytics_event(payload: AnalyticsEventIn, request: Request):
 # ------------------------
 
 @app.get("/api/automation/flows")
-def list_flows(request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    flows = list(collection("automationflow").find({"owner_id": user_id}).sort("created_at", -1))
-    for f in flows:
-        f["_id"] = str(f["_id"])
-    return flows
+async def list_flows(user_id: str = Depends(require_user)):
+    return await stream_documents(collection("automationflow").find({"owner_id": user_id}).sort("created_at", -1))
 
 @app.post("/api/automation/flows")
-def save_flow(payload: AutomationFlowIn, request: Request):
-    user_id = request.headers.get("X-User-Id")
-    require_user(user_id)
-    fid = create_document("automationflow", {
+async def save_flow(payload: AutomationFlowIn, user_id: str = Depends(require_user)):
+    fid = await create_document("automationflow", {
         "owner_id": user_id,
         "name": payload.name,
         "nodes": payload.nodes,
@@ -461,7 +801,12 @@ def execute_flow(payload: AutomationExecuteIn):
     logs: List[str] = []
     ctx = payload.payload.copy()
 
-    node_map = {n.get("id"): n for n in payload.nodes}
+    # node id -> position, so visited tracking is a bit test on an int
+    node_idx = {n.get("id"): i for i, n in enumerate(payload.nodes)}
+    # first outgoing edge per node, so each step is a dict lookup
+    next_map: Dict[Any, Any] = {}
+    for e in payload.edges:
+        next_map.setdefault(e.get("from"), e.get("to"))
     # naive: start with first node with type == 'trigger'
     start_nodes = [n for n in payload.nodes if n.get("type") == "trigger"] or payload.nodes[:1]
 
@@ -469,14 +814,19 @@ def execute_flow(payload: AutomationExecuteIn):
         ts = now_utc().isoformat()
         logs.append(f"[{ts}] {msg}")
 
+    steps = 0
     for start in start_nodes:
         current_id = start.get("id")
-        visited = set()
-        while current_id and current_id not in visited:
-            visited.add(current_id)
-            node = node_map.get(current_id)
-            if not node:
+        visited_bits = 0
+        while current_id:
+            i = node_idx.get(current_id)
+            if i is None or visited_bits >> i & 1:
                 break
+            steps += 1
+            if steps > MAX_FLOW_STEPS:
+                raise HTTPException(status_code=422, detail="Flow exceeds step limit")
+            visited_bits |= 1 << i
+            node = payload.nodes[i]
             ntype = node.get("type")
             cfg = node.get("config", {})
             if ntype == "trigger":
@@ -484,7 +834,7 @@ def execute_flow(payload: AutomationExecuteIn):
             elif ntype == "condition":
                 cond = cfg.get("expr", "True")
                 try:
-                    ok = bool(eval(cond, {}, {"ctx": ctx}))
+                    ok = bool(compile_expr(cond)(ctx))
                 except Exception:
                     ok = False
                 log(f"Condition '{cond}' -> {ok}")
@@ -499,8 +849,7 @@ def execute_flow(payload: AutomationExecuteIn):
                 else:
                     log(f"Action: {act}")
             # move to next via first matching edge
-            next_edges = [e for e in payload.edges if e.get("from") == current_id]
-            current_id = next_edges[0]["to"] if next_edges else None
+            current_id = next_map.get(current_id)
 
     return {"ok": True, "logs": logs, "context": ctx}
 
@@ -513,16 +862,20 @@ MINIAPPS = [
     {"id": "tasks", "name": "Tasks", "icon": "check", "pages": ["Today", "Upcoming"]},
 ]
 
+# Static, so encode once at import
+MINIAPPS_BYTES = orjson.dumps(MINIAPPS)
+MINIAPP_BYTES = {m["id"]: orjson.dumps(m) for m in MINIAPPS}
+
 @app.get("/api/miniapps")
 def miniapps():
-    return MINIAPPS
+    return Response(content=MINIAPPS_BYTES, media_type="application/json")
 
 @app.get("/api/miniapps/{app_id}")
 def miniapp_detail(app_id: str):
-    for m in MINIAPPS:
-        if m["id"] == app_id:
-            return m
-    raise HTTPException(status_code=404, detail="Mini-app not found")
+    body = MINIAPP_BYTES.get(app_id)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Mini-app not found")
+    return Response(content=body, media_type="application/json")
 
 # ------------------------
 # Export endpoints
@@ -558,4 +911,8 @@ def export_backend():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Workers only share websocket broadcasts through Redis (REDIS_URL), so
+    # without it stay on a single process
+    workers = int(os.getenv("WEB_CONCURRENCY", min(4, os.cpu_count() or 1))) if redis is not None else 1
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers,
+                loop="uvloop", http="httptools", ws="websockets", log_level="warning")
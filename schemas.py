@@ -75,3 +75,10 @@ class AnalyticsEvent(BaseModel):
     user_id: str
     event: str
     meta: Dict[str, Any] = Field(default_factory=dict)
+
+# Model listing served by the /schema endpoint; fixed once the module is imported
+SCHEMA_DUMP = tuple(
+    {"name": name, "fields": tuple(cls.model_fields.keys())}
+    for name, cls in sorted(globals().items())
+    if isinstance(cls, type) and issubclass(cls, BaseModel) and cls is not BaseModel
+)